@@ -13,8 +13,8 @@ https://juju.is/docs/sdk/create-a-minimal-kubernetes-charm
 """
 
 import logging
+from functools import cached_property
 
-import requests
 import ops
 from charms.data_platform_libs.v0.data_interfaces import DatabaseCreatedEvent
 from charms.data_platform_libs.v0.data_interfaces import DatabaseRequires
@@ -22,7 +22,15 @@ from ops.model import WaitingStatus
 # Log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
 
-VALID_LOG_LEVELS = ["info", "debug", "warning", "error", "critical"]
+VALID_LOG_LEVELS = frozenset({"info", "debug", "warning", "error", "critical"})
+
+# Static parts of the Pebble layer; only the service environment is dynamic.
+_NESSIE_SERVICE_TEMPLATE: ops.pebble.ServiceDict = {
+    "override": "replace",
+    "summary": "nessie",
+    "command": "/usr/local/s2i/run",
+    "startup": "enabled",
+}
 
 
 class NessieCharm(ops.CharmBase):
@@ -34,11 +42,15 @@ class NessieCharm(ops.CharmBase):
         self.container = self.unit.get_container("nessie")
         self.framework.observe(self.on.nessie_pebble_ready, self._on_nessie_pebble_ready)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self._db_cache = None
+        self._last_layer_sig = None
+        self._pending_layer = None
+        self._can_connect_cache = None
         self.database = DatabaseRequires(self, relation_name="database", database_name="names_db")
         self.framework.observe(self.database.on.database_created, self._on_database_created)
         self.framework.observe(self.database.on.endpoints_changed, self._on_database_created)
         self.framework.observe(self.on.database_relation_broken, self._on_database_relation_removed)
-        self.unit.set_workload_version(self.version)
+        self.framework.observe(self.framework.on.pre_commit, self._flush_pending)
 
     def _on_nessie_pebble_ready(self, event: ops.PebbleReadyEvent):
         """Define and start a workload using the Pebble API.
@@ -48,15 +60,8 @@ class NessieCharm(ops.CharmBase):
 
         Learn more about interacting with Pebble at at https://juju.is/docs/sdk/pebble.
         """
-        # Get a reference the container attribute on the PebbleReadyEvent
-        container = event.workload
-        # Add initial Pebble config layer using the Pebble API
-        container.add_layer("nessie", self._pebble_layer, combine=True)
-        # Make Pebble reevaluate its plan, ensuring any services are started if enabled.
-        container.replan()
-        # Learn more about statuses in the SDK docs:
-        # https://juju.is/docs/sdk/constructs#heading--statuses
-        self.unit.status = ops.ActiveStatus()
+        # Queue the initial Pebble config layer; it is applied once at the end of the dispatch
+        self._update_layer_and_restart(event)
 
     def _on_config_changed(self, event: ops.ConfigChangedEvent):
         """Handle changed configuration.
@@ -66,36 +71,45 @@ class NessieCharm(ops.CharmBase):
 
         Learn more about config at https://juju.is/docs/sdk/config
         """
-
         self._handle_ports()
+        # Re-evaluate the workload; this also sets or clears the invalid log level block
+        self._update_layer_and_restart(event)
 
     def _on_database_created(self, event: DatabaseCreatedEvent) -> None:
         """Event is fired when postgres database is created."""
+        self._invalidate_db_cache()
         self._update_layer_and_restart(None)
 
     def _on_database_relation_removed(self, event) -> None:
         """Event is fired when relation with postgres is broken."""
-        self.unit.status = ops.WaitingStatus("Waiting for database relation")
-    @property
+        self._invalidate_db_cache()
+        self._set_status(ops.WaitingStatus("Waiting for database relation"))
+
+    def _invalidate_db_cache(self) -> None:
+        """Drop cached relation data so it is re-read on next access."""
+        self._db_cache = None
+        self.__dict__.pop("app_environment", None)
+
+    @cached_property
     def app_environment(self):
         """This property method creates a dictionary containing environment variables
         for the application. It retrieves the database authentication data by calling
         the `fetch_postgres_relation_data` method and uses it to populate the dictionary.
         If any of the values are not present, it will be set to None.
-        The method returns this dictionary as output.
+        The method returns this dictionary as output. The result is cached for
+        the lifetime of the charm instance, i.e. a single hook invocation.
         """
         logger.info("Collecting relation data")
         db_data = self.fetch_postgres_relation_data()
         logger.info("Populating env")
         env = {
             "NESSIE_VERSION_STORE_TYPE": "JDBC",
-            "QUARKUS_DATASOURCE_JDBC_URL": "jdbc:postgresql://"+db_data.get("db_host", None)+":"+db_data.get("db_port", None)+"/"+db_data.get("db_database", None),
+            "QUARKUS_DATASOURCE_JDBC_URL": f"jdbc:postgresql://{db_data['db_host']}:{db_data['db_port']}/{db_data['db_database']}",
             "DEMO_SERVER_DB_HOST": db_data.get("db_host", None),
             "DEMO_SERVER_DB_PORT": db_data.get("db_port", None),
             "QUARKUS_DATASOURCE_USERNAME": db_data.get("db_username", None),
             "QUARKUS_DATASOURCE_PASSWORD": db_data.get("db_password", None),
         }
-        logger.info('Dict: %s', env)
         logger.info("Returning env")
         return env
     def fetch_postgres_relation_data(self) -> dict:
@@ -106,24 +120,33 @@ class NessieCharm(ops.CharmBase):
         then logged for debugging purposes, and any non-empty data is processed to extract
         endpoint information, username, and password. This processed data is then returned as
         a dictionary. If no data is retrieved, the unit is set to waiting status and
-        the program exits with a zero status code."""
+        the program exits with a zero status code. The parsed data is cached
+        until the database relation changes."""
+        if self._db_cache is not None:
+            return self._db_cache
         relations = self.database.fetch_relation_data()
-        logger.debug("Got following database data: %s", relations)
-        for data in relations.values():
-            if not data:
-                continue
-            logger.info("New PSQL database endpoint is %s", data["endpoints"])
-            host, port = data["endpoints"].split(":")
-            db_data = {
-                "db_host": host,
-                "db_port": port,
-                "db_username": data["username"],
-                "db_password": data["password"],
-                "db_database": "names_db"
+        if logger.isEnabledFor(logging.DEBUG):
+            # Building the redacted copy is only worth it when debug logging is on
+            redacted = {
+                relation_id: {k: v for k, v in data.items() if k != "password"}
+                for relation_id, data in relations.items()
             }
-            return db_data
-        self.unit.status = WaitingStatus("Waiting for database relation")
-        raise DatabaseNotReady()
+            logger.debug("Got following database data: %s", redacted)
+        data = next((d for d in relations.values() if d), None)
+        if data is None:
+            self._set_status(WaitingStatus("Waiting for database relation"))
+            raise DatabaseNotReady()
+        logger.info("New PSQL database endpoint is %s", data["endpoints"])
+        host, port = data["endpoints"].rsplit(":", 1)
+        db_data = {
+            "db_host": host,
+            "db_port": port,
+            "db_username": data["username"],
+            "db_password": data["password"],
+            "db_database": "names_db"
+        }
+        self._db_cache = db_data
+        return db_data
 
     @property
     def _pebble_layer(self) -> ops.pebble.LayerDict:
@@ -133,10 +156,7 @@ class NessieCharm(ops.CharmBase):
             "description": "pebble config layer for nessie",
             "services": {
                 self.pebble_service_name: {
-                    "override": "replace",
-                    "summary": "nessie",
-                    "command": "/usr/local/s2i/run",
-                    "startup": "enabled",
+                    **_NESSIE_SERVICE_TEMPLATE,
                     "environment": self.app_environment,
                 }
             },
@@ -145,7 +165,7 @@ class NessieCharm(ops.CharmBase):
     @property
     def version(self) -> str:
         """Reports the current workload (FastAPI app) version."""
-        if self.container.can_connect() and self.container.get_services(self.pebble_service_name):
+        if self._can_connect() and self.container.get_services(self.pebble_service_name):
             try:
                 return self._request_version()
             # Catching Exception is not ideal, but we don't care much for the error here, and just
@@ -161,10 +181,28 @@ class NessieCharm(ops.CharmBase):
         #return resp.json()["version"]
         return "1.0"
 
+    def _can_connect(self) -> bool:
+        """Probe Pebble connectivity, reusing a successful probe for this hook.
+
+        Only a positive result is cached, so a container that becomes reachable
+        later in the dispatch (e.g. on pebble-ready) is picked up.
+        """
+        if not self._can_connect_cache:
+            self._can_connect_cache = self.container.can_connect()
+        return self._can_connect_cache
+
     def _handle_ports(self):
         port = int(self.config["webui-port"])
         self.unit.set_ports(port)
 
+    def _set_status(self, status: ops.StatusBase) -> None:
+        """Set the unit status, unless the configured log level is invalid."""
+        log_level = str(self.config["log-level"]).lower()
+        if log_level not in VALID_LOG_LEVELS:
+            # In this case, the config option is bad, so block the charm and notify the operator.
+            status = ops.BlockedStatus(f"invalid log level: '{log_level}'")
+        self.unit.status = status
+
     def _update_layer_and_restart(self, event) -> None:
         """Define and start a workload using the Pebble API.
 
@@ -176,28 +214,55 @@ class NessieCharm(ops.CharmBase):
         """
         # Learn more about statuses in the SDK docs:
         # https://juju.is/docs/sdk/constructs#heading--statuses
-        self.unit.status = ops.MaintenanceStatus("Assembling pod spec")
-        if self.container.can_connect():
+        self._set_status(ops.MaintenanceStatus("Assembling pod spec"))
+        if self._can_connect():
             try:
                 new_layer = self._pebble_layer
             except DatabaseNotReady:
-                self.unit.status = ops.WaitingStatus("Waiting for database relation")
+                self._set_status(ops.WaitingStatus("Waiting for database relation"))
                 return
-            # Get the current pebble layer config
-            services = self.container.get_plan().to_dict().get("services", {})
-            if services != new_layer["services"]:
-                # Changes were made, add the new layer
-                self.container.add_layer("nessie", self._pebble_layer, combine=True)
-                logger.info("Added updated layer 'nessie' to Pebble plan")
-
-                self.container.restart(self.pebble_service_name)
-                logger.info(f"Restarted '{self.pebble_service_name}' service")
-
-            # add workload version in juju status
-            self.unit.set_workload_version(self.version)
-            self.unit.status = ops.ActiveStatus()
+            # Skip the Pebble round-trips if this charm instance already handled the same
+            # environment; the rest of the service is the static _NESSIE_SERVICE_TEMPLATE.
+            new_sig = tuple(sorted(self.app_environment.items()))
+            if new_sig != self._last_layer_sig:
+                # Get the current pebble layer config
+                services = self.container.get_plan().to_dict().get("services", {})
+                if services != new_layer["services"]:
+                    # Changes were made, queue the new layer for the end of the dispatch
+                    self._pending_layer = new_layer
+                self._last_layer_sig = new_sig
+
+            if self._pending_layer is None:
+                # add workload version in juju status
+                self.unit.set_workload_version(self.version)
+                self._set_status(ops.ActiveStatus())
         else:
-            self.unit.status = ops.WaitingStatus("Waiting for Pebble in workload container")
+            self._set_status(ops.WaitingStatus("Waiting for Pebble in workload container"))
+
+    def _flush_pending(self, event) -> None:
+        """Apply the queued Pebble layer and replan once per hook dispatch.
+
+        Handlers only queue layer changes, so several events handled in the same
+        dispatch (e.g. pebble-ready followed by database-created) result in a
+        single add_layer/replan and at most one workload restart.
+        """
+        if self._pending_layer is None:
+            return
+        layer, self._pending_layer = self._pending_layer, None
+        if not self.container.can_connect():
+            logger.warning("Pebble is unreachable, dropping queued layer 'nessie'")
+            self._set_status(ops.WaitingStatus("Waiting for Pebble in workload container"))
+            return
+        self.container.add_layer("nessie", layer, combine=True)
+        logger.info("Added updated layer 'nessie' to Pebble plan")
+        # Make Pebble reevaluate its plan, restarting the service if its config changed.
+        self.container.replan()
+        logger.info(f"Replanned '{self.pebble_service_name}' service")
+
+        # add workload version in juju status
+        self.unit.set_workload_version(self.version)
+        self._set_status(ops.ActiveStatus())
+
 
 class DatabaseNotReady(Exception):
     """Signals that the database cannot yet be used."""
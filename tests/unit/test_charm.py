@@ -4,6 +4,7 @@
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
 import unittest
+from unittest.mock import patch
 
 import ops
 import ops.testing
@@ -16,41 +17,100 @@ class TestCharm(unittest.TestCase):
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
 
+    def add_database_relation(self, endpoints="postgresql:5432"):
+        return self.harness.add_relation(
+            "database",
+            "postgresql",
+            app_data={
+                "endpoints": endpoints,
+                "username": "nessie",
+                "password": "secret",
+                "database": "names_db",
+            },
+        )
+
     def test_nessie_pebble_ready(self):
-        # Expected plan after Pebble ready with default config
+        self.add_database_relation()
+        # Expected plan after Pebble ready with the database related
         expected_plan = {
             "services": {
-                "httpbin": {
+                "nessie-service": {
                     "override": "replace",
-                    "summary": "httpbin",
-                    "command": "gunicorn -b 0.0.0.0:80 httpbin:app -k gevent",
+                    "summary": "nessie",
+                    "command": "/usr/local/s2i/run",
                     "startup": "enabled",
-                    "environment": {"GUNICORN_CMD_ARGS": "--log-level info"},
+                    "environment": {
+                        "NESSIE_VERSION_STORE_TYPE": "JDBC",
+                        "QUARKUS_DATASOURCE_JDBC_URL": "jdbc:postgresql://postgresql:5432/names_db",
+                        "DEMO_SERVER_DB_HOST": "postgresql",
+                        "DEMO_SERVER_DB_PORT": "5432",
+                        "QUARKUS_DATASOURCE_USERNAME": "nessie",
+                        "QUARKUS_DATASOURCE_PASSWORD": "secret",
+                    },
                 }
             },
         }
         # Simulate the container coming up and emission of pebble-ready event
         self.harness.container_pebble_ready("nessie")
-        # Get the plan now we've run PebbleReady
+        # The layer is only queued until the framework commits
+        self.assertEqual(self.harness.get_container_pebble_plan("nessie").to_dict(), {})
+        self.harness.framework.commit()
+        # Get the plan now we've committed
         updated_plan = self.harness.get_container_pebble_plan("nessie").to_dict()
         # Check we've got the plan we expected
         self.assertEqual(expected_plan, updated_plan)
         # Check the service was started
-        service = self.harness.model.unit.get_container("nessie").get_service("nessie")
+        service = self.harness.model.unit.get_container("nessie").get_service("nessie-service")
         self.assertTrue(service.is_running())
         # Ensure we set an ActiveStatus with no message
         self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus())
 
+    def test_workload_version_set_after_replan(self):
+        self.add_database_relation()
+        self.harness.container_pebble_ready("nessie")
+        self.assertIsNone(self.harness.get_workload_version())
+        self.harness.framework.commit()
+        self.assertEqual(self.harness.get_workload_version(), "1.0")
+
+    def test_nessie_pebble_ready_without_database(self):
+        self.harness.container_pebble_ready("nessie")
+        self.harness.framework.commit()
+        self.assertEqual(self.harness.get_container_pebble_plan("nessie").to_dict(), {})
+        self.assertEqual(
+            self.harness.model.unit.status, ops.WaitingStatus("Waiting for database relation")
+        )
+
+    def test_layer_applied_once_per_commit(self):
+        self.add_database_relation()
+        self.harness.container_pebble_ready("nessie")
+        # A second layer update in the same dispatch must not queue another change
+        self.harness.charm._on_database_created(None)
+        container = self.harness.model.unit.get_container("nessie")
+        with patch.object(container, "replan", wraps=container.replan) as replan:
+            self.harness.framework.commit()
+            self.harness.framework.commit()
+        replan.assert_called_once()
+
+    def test_flush_cannot_connect(self):
+        self.add_database_relation()
+        self.harness.container_pebble_ready("nessie")
+        self.harness.set_can_connect("nessie", False)
+        self.harness.framework.commit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ops.WaitingStatus("Waiting for Pebble in workload container"),
+        )
+
     def test_config_changed_valid_can_connect(self):
+        self.add_database_relation()
         # Ensure the simulated Pebble API is reachable
         self.harness.set_can_connect("nessie", True)
         # Trigger a config-changed event with an updated value
         self.harness.update_config({"log-level": "debug"})
-        # Get the plan now we've run PebbleReady
+        self.harness.framework.commit()
+        # Check the layer was applied
         updated_plan = self.harness.get_container_pebble_plan("nessie").to_dict()
-        updated_env = updated_plan["services"]["nessie"]["environment"]
-        # Check the config change was effective
-        self.assertEqual(updated_env, {"GUNICORN_CMD_ARGS": "--log-level debug"})
+        self.assertIn("nessie-service", updated_plan["services"])
         self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus())
 
     def test_config_changed_valid_cannot_connect(self):
@@ -66,3 +126,107 @@ class TestCharm(unittest.TestCase):
         self.harness.update_config({"log-level": "foobar"})
         # Check the charm is in BlockedStatus
         self.assertIsInstance(self.harness.model.unit.status, ops.BlockedStatus)
+
+    def test_config_changed_invalid_then_valid(self):
+        self.add_database_relation()
+        self.harness.set_can_connect("nessie", True)
+        self.harness.update_config({"log-level": "foobar"})
+        self.assertEqual(
+            self.harness.model.unit.status, ops.BlockedStatus("invalid log level: 'foobar'")
+        )
+        # Fixing the config clears the block
+        self.harness.update_config({"log-level": "info"})
+        self.harness.framework.commit()
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus())
+
+    def test_fetch_postgres_relation_data_host_port(self):
+        self.add_database_relation("postgresql:5432")
+        db_data = self.harness.charm.fetch_postgres_relation_data()
+        self.assertEqual(db_data["db_host"], "postgresql")
+        self.assertEqual(db_data["db_port"], "5432")
+        self.assertEqual(
+            self.harness.charm.app_environment["QUARKUS_DATASOURCE_JDBC_URL"],
+            "jdbc:postgresql://postgresql:5432/names_db",
+        )
+
+    def test_fetch_postgres_relation_data_ipv6(self):
+        self.add_database_relation("[::1]:5432")
+        db_data = self.harness.charm.fetch_postgres_relation_data()
+        self.assertEqual(db_data["db_host"], "[::1]")
+        self.assertEqual(db_data["db_port"], "5432")
+        self.assertEqual(
+            self.harness.charm.app_environment["QUARKUS_DATASOURCE_JDBC_URL"],
+            "jdbc:postgresql://[::1]:5432/names_db",
+        )
+
+    def test_endpoints_changed_invalidates_db_cache(self):
+        self.harness.set_can_connect("nessie", True)
+        rel_id = self.add_database_relation("postgresql:5432")
+        self.harness.framework.commit()
+        self.assertEqual(
+            self.harness.charm.app_environment["QUARKUS_DATASOURCE_JDBC_URL"],
+            "jdbc:postgresql://postgresql:5432/names_db",
+        )
+        database = self.harness.charm.database
+        with patch.object(
+            database, "fetch_relation_data", wraps=database.fetch_relation_data
+        ) as fetch:
+            # Triggers endpoints_changed, which must drop the cached relation data
+            self.harness.update_relation_data(rel_id, "postgresql", {"endpoints": "replica:5432"})
+            self.harness.charm.fetch_postgres_relation_data()
+            self.harness.charm.app_environment
+        fetch.assert_called_once()
+        self.assertEqual(
+            self.harness.charm.app_environment["QUARKUS_DATASOURCE_JDBC_URL"],
+            "jdbc:postgresql://replica:5432/names_db",
+        )
+        self.harness.framework.commit()
+        plan = self.harness.get_container_pebble_plan("nessie").to_dict()
+        environment = plan["services"]["nessie-service"]["environment"]
+        self.assertEqual(environment["DEMO_SERVER_DB_HOST"], "replica")
+
+    def test_debug_log_omits_password(self):
+        self.add_database_relation()
+        with self.assertLogs("charm", level="DEBUG") as logs:
+            self.harness.charm._invalidate_db_cache()
+            self.harness.charm.fetch_postgres_relation_data()
+        self.assertTrue(any("nessie" in line for line in logs.output))
+        self.assertFalse(any("secret" in line for line in logs.output))
+
+    def test_can_connect_false_not_cached(self):
+        self.harness.set_can_connect("nessie", False)
+        self.add_database_relation()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ops.WaitingStatus("Waiting for Pebble in workload container"),
+        )
+        # The same charm instance must see the container once it becomes reachable
+        self.harness.set_can_connect("nessie", True)
+        self.harness.charm._on_database_created(None)
+        self.harness.framework.commit()
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus())
+
+    def test_can_connect_probed_once(self):
+        self.harness.set_can_connect("nessie", True)
+        container = self.harness.charm.container
+        with patch.object(container, "can_connect", wraps=container.can_connect) as probe:
+            self.add_database_relation()
+            self.harness.charm._on_database_created(None)
+            self.harness.charm.version
+            self.harness.charm.version
+        probe.assert_called_once()
+
+    def test_config_changed_invalid_then_database_created(self):
+        self.harness.set_can_connect("nessie", True)
+        self.harness.update_config({"log-level": "foobar", "webui-port": 8080})
+        # Ports are still handled for an invalid log level
+        self.assertEqual(self.harness.model.unit.opened_ports(), {ops.Port("tcp", 8080)})
+        self.add_database_relation()
+        self.harness.framework.commit()
+        # The layer is applied, but the block holds while the value is invalid
+        self.assertIn(
+            "nessie-service", self.harness.get_container_pebble_plan("nessie").to_dict()["services"]
+        )
+        self.assertEqual(
+            self.harness.model.unit.status, ops.BlockedStatus("invalid log level: 'foobar'")
+        )